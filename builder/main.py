@@ -4,10 +4,19 @@ Handles compilation and linking of Arduino-compatible code with ESP-IDF
 Includes ESP32-P4 upload fixes for M5Stack Tab5 hardware
 """
 
+import hashlib
+import json
 import os
+import pickle
+import re
+import shutil
 import sys
-from os.path import isdir, join, realpath
+from os.path import isdir, isfile, join, realpath
 from SCons.Script import DefaultEnvironment
+from SCons.Tool import createObjBuilders
+
+# Status lines, printed as one block at the end in verbose mode
+msgs = []
 
 # Import ESP32-P4 upload fix
 current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -15,7 +24,7 @@ upload_script = os.path.join(current_dir, "upload_esp32p4.py")
 if os.path.exists(upload_script):
     try:
         exec(open(upload_script).read())
-        print("✓ ESP32-P4 upload fix loaded")
+        msgs.append("✓ ESP32-P4 upload fix loaded")
     except Exception as e:
         print(f"Warning: ESP32-P4 upload fix failed to load: {e}")
 
@@ -23,172 +32,407 @@ env = DefaultEnvironment()
 platform = env.PioPlatform()
 board = env.BoardConfig()
 
+# Board configuration (read once)
+variant = board.get("build.variant", "")
+f_cpu = board.get("build.f_cpu", "400000000L")
+psram_type = board.get("build.psram_type", "")
+psram_size = board.get("build.psram_size", "32MB")
+mcu = board.get("build.mcu", "esp32p4")
+flash_size = board.get("upload.flash_size", "16MB")
+# -O2 by default, size-constrained variants can set build.opt_level = -Os
+opt_level = board.get("build.opt_level", env.get("BUILD_OPTIMIZATION", "-O2"))
+# build.tab5_lto = 0 for code that needs -Og/-Os inlining semantics
+use_lto = str(board.get("build.tab5_lto", "1")) == "1"
+# build.riscv_bitmanip = 1 emits Zba/Zbb/Zbs instructions; opt-in only, ESP-IDF builds
+# esp32p4 without Zb* and the HP core would trap on them as illegal instructions
+riscv_bitmanip = str(board.get("build.riscv_bitmanip", "0")) == "1"
+march = "rv32imafc_zba_zbb_zbs" if riscv_bitmanip else "rv32imafc"
+# build.tab5_threadsafe_statics = 0 drops static-init guards (single-core use only)
+threadsafe_statics = str(board.get("build.tab5_threadsafe_statics", "1")) == "1"
+
+# Use ccache/sccache as compiler launcher when available (BUILD_CACHE_LAUNCHER=0 disables)
+launcher = shutil.which("ccache") or shutil.which("sccache")
+if launcher and env.get("BUILD_CACHE_LAUNCHER", "1") != "0":
+    for key in ("CC", "CXX"):
+        exe = env.subst("$" + key)
+        if exe and launcher not in exe:
+            env.Replace(**{key: "{} {}".format(launcher, exe)})
+    env["ENV"].setdefault("CCACHE_BASEDIR", env.subst("$PROJECT_DIR"))
+    env["ENV"].setdefault("CCACHE_SLOPPINESS", "pch_defines,time_macros,include_file_mtime")
+    msgs.append("Tab5duino-IDF: compiler cache active via {}".format(launcher))
+
 # Framework configuration
 FRAMEWORK_DIR = platform.get_package_dir("framework-tab5duino-idf")
 FRAMEWORK_VERSION = "1.0.0"
 
-print("Tab5duino-IDF Framework v{} - ESP32-P4 M5Stack Tab5".format(FRAMEWORK_VERSION))
+msgs.append("Tab5duino-IDF Framework v{} - ESP32-P4 M5Stack Tab5".format(FRAMEWORK_VERSION))
 
-# Add framework paths
-env.Prepend(
-    CPPPATH=[
-        join(FRAMEWORK_DIR, "cores", "tab5duino"),
-        join(FRAMEWORK_DIR, "cores", "tab5duino", "hal"),
-        join(FRAMEWORK_DIR, "libraries"),
-        join(FRAMEWORK_DIR, "variants", env.BoardConfig().get("build.variant", ""))
-    ]
-)
-
-# Compiler flags for ESP32-P4 RISC-V
-env.Append(
-    CPPDEFINES=[
-        "ARDUINO_ARCH_ESP32",
-        "ESP32",
-        "ESP32P4",
-        "ARDUINO_BOARD=\\\"{}\\\"".format(env.BoardConfig().get("build.variant", "").upper()),
-        ("F_CPU", board.get("build.f_cpu", "400000000L")),
-        ("ARDUINO", 10812),
-        ("TAB5DUINO_FRAMEWORK", "1"),
-        "__RISC_V__",
-    ],
-
-    CFLAGS=[
-        "-std=gnu17"
-    ],
-
-    CXXFLAGS=[
-        "-std=gnu++17",
-        "-fno-rtti",
-        "-fno-exceptions"
-    ],
-
-    CCFLAGS=[
-        "-Os",  # Optimize for size
-        "-march=rv32imafc",
-        "-mabi=ilp32f",
-        "-ffunction-sections",
-        "-fdata-sections",
-        "-Wall",
-        "-Wextra",
-        "-Wno-unused-parameter",
-        "-Wno-unused-function",
-        "-Wno-unused-variable",
-        "-Wno-deprecated-declarations",
-        "-Wno-missing-field-initializers",
-        "-Wno-sign-compare"
-    ],
-
-    LINKFLAGS=[
-        "-Os",
-        "-march=rv32imafc", 
-        "-mabi=ilp32f",
-        "-Wl,--gc-sections",
-        "-Wl,--cref",
-        "-Wl,--check-sections",
-        "-Wl,--unresolved-symbols=report-all",
-        "-Wl,--warn-common",
-        "-Wl,--warn-section-align"
-    ]
-)
+# Link-time optimization
+lto_flags = ["-flto=auto", "-fno-fat-lto-objects"] if use_lto else []
+if use_lto:
+    # Slim LTO objects need the plugin-aware archiver to index their symbols
+    for key in ("AR", "RANLIB"):
+        exe = env.subst("$" + key)
+        tool = key.lower()
+        if exe.endswith("-" + tool) and not exe.endswith("gcc-" + tool):
+            env.Replace(**{key: exe[:-len(tool)] + "gcc-" + tool})
+
+# Let gcc emit dependency files and feed them to SCons instead of re-scanning includes
+env.SetOption("implicit_cache", 1)
+
+
+def _read_depfile(path):
+    """Return the prerequisites listed in a gcc depfile"""
+    with open(path) as fp:
+        text = fp.read().replace("\\\r\n", " ").replace("\\\n", " ")
+    deps = []
+    for line in text.splitlines():
+        # The rule separator is the first colon followed by whitespace; drive
+        # letters (C:/...) are followed by a path separator instead
+        match = re.search(r":(?=\s|$)", line)
+        if not match:
+            continue
+        # -MP phony rules ("header.h:") have no prerequisites and are skipped here;
+        # escaped spaces ("\ ") stay part of the path
+        for token in re.split(r"(?<!\\)\s+", line[match.end():].strip()):
+            if token:
+                deps.append(token.replace("\\ ", " ").replace("$$", "$"))
+    return list(dict.fromkeys(deps))
+
+
+def _with_depfiles(emitter):
+    """Wrap an object emitter so each object picks up the .d file from its last compile"""
+    def emit(target, source, env):
+        if emitter:
+            target, source = emitter(target, source, env)
+        for node in target:
+            depfile = os.path.splitext(node.get_abspath())[0] + ".d"
+            if not isfile(depfile):
+                continue
+            try:
+                deps = _read_depfile(depfile)
+            except OSError:
+                continue
+            # Headers deleted or renamed since the last compile have no builder;
+            # dropping them is what -MP's phony rules do for make
+            deps = [dep for dep in deps if os.path.exists(dep)]
+            if deps:
+                env.Depends(node, deps)
+        return target, source
+    return emit
+
+
+static_obj, _ = createObjBuilders(env)
+for suffix in list(static_obj.emitter):
+    static_obj.add_emitter(suffix, _with_depfiles(static_obj.emitter[suffix]))
+
+# Source discovery
+SOURCE_EXTENSIONS = frozenset({".c", ".cpp", ".S"})
+_SOURCE_SUFFIXES = tuple(SOURCE_EXTENSIONS)
+SRCSCAN_CACHE = join(env.subst("$BUILD_DIR"), ".tab5_srcscan.json")
+
+
+def _dir_mtime(path):
+    """Return the mtime of a directory, or None if it is missing"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _dirs_unchanged(dir_mtimes):
+    """Return True if every recorded directory still has its recorded mtime"""
+    # A directory's mtime changes whenever an entry is added, removed or renamed
+    return all(_dir_mtime(path) == mtime for path, mtime in dir_mtimes.items())
+
+
+def _iter_sources(root, dirs=None):
+    """Yield C/C++/ASM sources under root using an explicit os.scandir stack"""
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        if dirs is not None:
+            dirs[path] = _dir_mtime(path)
+        try:
+            entries = os.scandir(path)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(_SOURCE_SUFFIXES):
+                    yield entry.path
+
+
+def _load_srcscan_cache():
+    # Package upgrades can restore archive mtimes, so the cache is also tied to package.json
+    try:
+        with open(SRCSCAN_CACHE) as fp:
+            cache = json.load(fp)
+        if cache.get("pkg") == _package_manifest_digest():
+            return cache["trees"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return {}
+
+
+# Loaded on first use and written back once by _save_srcscan_cache()
+_srcscan_cache = None
+_srcscan_dirty = False
+# Directory mtimes behind this run's scans, stored with the environment cache
+_scanned_dirs = {}
+
+
+def _scan_sources(root):
+    """Return C/C++/ASM sources under root, reusing the cached list while the tree is unchanged"""
+    global _srcscan_cache, _srcscan_dirty
+    if _srcscan_cache is None:
+        _srcscan_cache = _load_srcscan_cache()
+
+    entry = _srcscan_cache.get(root)
+    if entry and entry.get("dirs") and _dirs_unchanged(entry["dirs"]):
+        _scanned_dirs.update(entry["dirs"])
+        return entry["files"]
+
+    dirs = {}
+    files = list(_iter_sources(root, dirs))
+    _srcscan_cache[root] = {"dirs": dirs, "files": files}
+    _srcscan_dirty = True
+    _scanned_dirs.update(dirs)
+    return files
+
+
+def _save_srcscan_cache():
+    """Write the source scan cache if any tree was rescanned"""
+    if not _srcscan_dirty:
+        return
+    try:
+        os.makedirs(os.path.dirname(SRCSCAN_CACHE), exist_ok=True)
+        with open(SRCSCAN_CACHE, "w") as fp:
+            json.dump({"pkg": _package_manifest_digest(), "trees": _srcscan_cache}, fp)
+    except OSError as e:
+        print(f"Warning: could not write source scan cache: {e}")
+
+
+core_dir = join(FRAMEWORK_DIR, "cores", "tab5duino")
+variant_dir = join(FRAMEWORK_DIR, "variants", variant)
+
+
+def _compute_env_delta():
+    """Compute the framework include paths, flags and library sources for this board"""
+    prepend = {
+        "CPPPATH": [
+            join(FRAMEWORK_DIR, "cores", "tab5duino"),
+            join(FRAMEWORK_DIR, "cores", "tab5duino", "hal"),
+            join(FRAMEWORK_DIR, "libraries"),
+            join(FRAMEWORK_DIR, "variants", variant)
+        ]
+    }
+
+    # Compiler flags for ESP32-P4 RISC-V
+    append = dict(
+        CPPDEFINES=[
+            "ARDUINO_ARCH_ESP32",
+            "ESP32",
+            "ESP32P4",
+            "ARDUINO_BOARD=\\\"{}\\\"".format(variant.upper()),
+            ("F_CPU", f_cpu),
+            ("ARDUINO", 10812),
+            ("TAB5DUINO_FRAMEWORK", "1"),
+            "__RISC_V__",
+            "ESP_PLATFORM",
+            ("IDF_VER", "v5.3-dev"),
+        ],
+
+        CFLAGS=[
+            "-std=gnu17"
+        ],
+
+        CXXFLAGS=[
+            "-std=gnu++17",
+            "-fno-rtti",
+            "-fno-exceptions"
+        ] + (["-fdevirtualize-at-ltrans"] if use_lto else [])
+          + ([] if threadsafe_statics else ["-fno-threadsafe-statics"]),
+
+        CCFLAGS=[
+            opt_level,
+            "-march=" + march,
+            "-mabi=ilp32f",
+            "-ffunction-sections",
+            "-fdata-sections",
+            "-fmerge-all-constants",
+            "-fno-semantic-interposition",
+            "-Wall",
+            "-Wextra",
+            "-Wno-unused-parameter",
+            "-Wno-unused-function",
+            "-Wno-unused-variable",
+            "-Wno-deprecated-declarations",
+            "-Wno-missing-field-initializers",
+            "-Wno-sign-compare",
+            "-MMD",
+            "-MP"
+        ] + lto_flags,
 
-# Memory configuration for ESP32-P4
-env.Append(
-    LINKFLAGS=[
+        LINKFLAGS=[
+            opt_level,
+            "-march=" + march, 
+            "-mabi=ilp32f",
+            "-Wl,--gc-sections",
+            "-Wl,--cref",
+            "-Wl,--check-sections",
+            "-Wl,--unresolved-symbols=report-all",
+            "-Wl,--warn-common",
+            "-Wl,--warn-section-align"
+        ] + (lto_flags + ["-fuse-linker-plugin"] if use_lto else []),
+
+        CPPPATH=[],
+        LIBSOURCE_DIRS=[]
+    )
+
+    # Memory configuration for ESP32-P4
+    append["LINKFLAGS"] += [
         "-Wl,--defsym=_start=0x42000000",
         "-Wl,--defsym=_heap_start=0x50000000"
     ]
-)
 
-# Enable PSRAM support if configured
-if board.get("build.psram_type", ""):
-    env.Append(
-        CPPDEFINES=[
+    # Enable PSRAM support if configured
+    if psram_type:
+        append["CPPDEFINES"] += [
             "BOARD_HAS_PSRAM",
             ("CONFIG_SPIRAM_SUPPORT", 1),
             ("CONFIG_SPIRAM_USE_CAPS_ALLOC", 1)
         ]
-    )
 
-# Add libraries path if exists
-libs_dir = join(FRAMEWORK_DIR, "libraries")
-if isdir(libs_dir):
-    env.Append(LIBSOURCE_DIRS=[libs_dir])
+    # Add libraries path if exists
+    libs_dir = join(FRAMEWORK_DIR, "libraries")
+    if isdir(libs_dir):
+        append["LIBSOURCE_DIRS"].append(libs_dir)
 
-# Framework core sources
-core_src = []
-core_dir = join(FRAMEWORK_DIR, "cores", "tab5duino")
+    # Framework core sources, built as one library per subsystem directory so
+    # SCons can compile them in parallel and skip untouched ones on rebuilds
+    libraries = []
+    if isdir(core_dir):
+        # Loose sources at the top of the core directory
+        with os.scandir(core_dir) as entries:
+            root_src = sorted(
+                entry.path for entry in entries
+                if entry.is_file() and entry.name.endswith(_SOURCE_SUFFIXES)
+            )
+        if root_src:
+            libraries.append(("FrameworkTab5duino_root", root_src))
 
-if isdir(core_dir):
-    for root, dirs, files in os.walk(core_dir):
-        for file in files:
-            if file.endswith(('.c', '.cpp', '.S')):
-                core_src.append(join(root, file))
-
-# HAL sources  
-hal_dir = join(core_dir, "hal")
-if isdir(hal_dir):
-    for root, dirs, files in os.walk(hal_dir):
-        for file in files:
-            if file.endswith(('.c', '.cpp', '.S')):
-                core_src.append(join(root, file))
-
-# Build framework library
-if core_src:
-    env.BuildLibrary(
-        join("$BUILD_DIR", "FrameworkTab5duino"),
-        core_src
-    )
+        for sub in sorted(os.listdir(core_dir)):
+            subpath = join(core_dir, sub)
+            if not isdir(subpath):
+                continue
+            # Stable, unique node list so SCons never compiles a translation unit twice
+            sub_src = sorted(set(_scan_sources(subpath)))
+            if sub_src:
+                libraries.append(("FrameworkTab5duino_" + sub, sub_src))
 
-# Variant configuration
-variant_dir = join(FRAMEWORK_DIR, "variants", board.get("build.variant", ""))
-if isdir(variant_dir):
-    env.Append(CPPPATH=[variant_dir])
-    
-    # Add variant-specific sources
-    variant_src = []
-    for root, dirs, files in os.walk(variant_dir):
-        for file in files:
-            if file.endswith(('.c', '.cpp', '.S')):
-                variant_src.append(join(root, file))
-    
-    if variant_src:
-        env.BuildLibrary(
-            join("$BUILD_DIR", "FrameworkVariant"),  
-            variant_src
-        )
-
-# ESP-IDF integration
-env.Append(
-    CPPDEFINES=[
-        "ESP_PLATFORM",
-        ("IDF_VER", "v5.3-dev")
+    # Variant configuration
+    if isdir(variant_dir):
+        append["CPPPATH"].append(variant_dir)
+
+        # Add variant-specific sources
+        variant_src = _scan_sources(variant_dir)
+        if variant_src:
+            libraries.append(("FrameworkVariant", variant_src))
+
+    # ESP-IDF integration: include paths (these would be provided by ESP-IDF platform)
+    esp_idf_includes = [
+        "components/esp_common/include",
+        "components/esp_system/include", 
+        "components/freertos/FreeRTOS-Kernel/include",
+        "components/freertos/esp_additions/include",
+        "components/driver/include",
+        "components/hal/esp32p4/include",
+        "components/hal/include",
+        "components/soc/esp32p4/include",
+        "components/soc/include",
+        "components/log/include",
+        "components/esp_timer/include",
+        "components/esp_pm/include"
     ]
-)
-
-# Add ESP-IDF include paths (these would be provided by ESP-IDF platform)
-esp_idf_includes = [
-    "components/esp_common/include",
-    "components/esp_system/include", 
-    "components/freertos/FreeRTOS-Kernel/include",
-    "components/freertos/esp_additions/include",
-    "components/driver/include",
-    "components/hal/esp32p4/include",
-    "components/hal/include",
-    "components/soc/esp32p4/include",
-    "components/soc/include",
-    "components/log/include",
-    "components/esp_timer/include",
-    "components/esp_pm/include"
-]
+    prepend["CPPPATH"] = [join(FRAMEWORK_DIR, p) for p in esp_idf_includes] + prepend["CPPPATH"]
+
+    # Listed or probed directly above, so their mtimes guard the cache as well
+    dirs = dict(_scanned_dirs)
+    for path in (libs_dir, core_dir, variant_dir):
+        dirs.setdefault(path, _dir_mtime(path))
+
+    return {"prepend": prepend, "append": append, "libraries": libraries, "dirs": dirs}
+
+
+def _package_manifest_digest():
+    """Return a digest of the framework package manifest (changes on every package upgrade)"""
+    try:
+        with open(join(FRAMEWORK_DIR, "package.json"), "rb") as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+# Reuse the environment delta from a previous run while the framework package and
+# board configuration are unchanged (PlatformIO runs this script many times).
+# The key avoids walking the source trees; a hit is checked against the stored
+# directory mtimes instead, one stat per directory without listing it
+env_cache_key = hashlib.sha1(json.dumps([
+    FRAMEWORK_VERSION,
+    FRAMEWORK_DIR,
+    os.stat(FRAMEWORK_DIR).st_mtime_ns if isdir(FRAMEWORK_DIR) else 0,
+    _package_manifest_digest(),
+    os.stat(os.path.realpath(__file__)).st_mtime_ns,
+    getattr(board, "manifest", {}),
+    [opt_level, use_lto],
+], sort_keys=True, default=str).encode()).hexdigest()
+ENV_CACHE = join(env.subst("$BUILD_DIR"), ".tab5_env_{}.pkl".format(env_cache_key))
+
+try:
+    with open(ENV_CACHE, "rb") as fp:
+        env_delta = pickle.load(fp)
+    if not _dirs_unchanged(env_delta["dirs"]):
+        raise ValueError("framework sources changed")
+except (OSError, EOFError, ValueError, KeyError, pickle.PickleError):
+    env_delta = _compute_env_delta()
+    _save_srcscan_cache()
+    try:
+        cache_dir = os.path.dirname(ENV_CACHE)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Drop caches from other framework versions or board configurations
+        for name in os.listdir(cache_dir):
+            if name.startswith(".tab5_env_") and name.endswith(".pkl"):
+                os.remove(join(cache_dir, name))
+        with open(ENV_CACHE, "wb") as fp:
+            pickle.dump(env_delta, fp)
+    except OSError as e:
+        print(f"Warning: could not write environment cache: {e}")
+
+env.Prepend(**env_delta["prepend"])
+env.Append(**env_delta["append"])
+
+core_src = []
+for name, sources in env_delta["libraries"]:
+    env.BuildLibrary(join("$BUILD_DIR", name), sources)
+    if name != "FrameworkVariant":
+        core_src += sources
 
 # Print build information
-print("Framework Directory: {}".format(FRAMEWORK_DIR))
-print("Core Sources: {} files".format(len(core_src)))
-print("Target MCU: {}".format(board.get("build.mcu", "esp32p4")))
-print("CPU Frequency: {} MHz".format(int(board.get("build.f_cpu", "400000000")) // 1000000))
-print("Flash Size: {}".format(board.get("upload.flash_size", "16MB")))
-if board.get("build.psram_type", ""):
-    print("PSRAM: Enabled ({} MB)".format(board.get("build.psram_size", "32MB")))
+msgs += [
+    "Framework Directory: {}".format(FRAMEWORK_DIR),
+    "Core Sources: {} files".format(len(core_src)),
+    "Target MCU: {}".format(mcu),
+    "CPU Frequency: {} MHz".format(int(str(f_cpu).rstrip("L")) // 1000000),
+    "Flash Size: {}".format(flash_size),
+]
+if psram_type:
+    msgs.append("PSRAM: Enabled ({} MB)".format(psram_size))
+
+if int(env.get("PIOVERBOSE", 0)):
+    sys.stdout.write("\n".join(msgs) + "\n")
 
 # Framework ready indicator
 env["FRAMEWORK_TAB5DUINO"] = True
\ No newline at end of file
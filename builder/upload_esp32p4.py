@@ -3,18 +3,20 @@ ESP32-P4 Upload Script for Tab5duino-IDF Framework
 Fixes PlatformIO upload issues with ESP32-P4 hardware
 """
 
-import os
-import subprocess
-import sys
 from SCons.Script import Import, Return
 
 Import("env")
 
+# ESP32-P4 USB-Serial-JTAG ignores the baud rate, but the stub still negotiates it
+DEFAULT_UPLOAD_SPEED = "921600"
+
 def upload_using_esptool(source, target, env):
     """Upload firmware to ESP32-P4 using esptool with correct chip parameter"""
+    # Imported here so registering the upload hook stays cheap on every SCons pass
+    import os
     
     upload_port = env.subst("$UPLOAD_PORT")
-    upload_speed = env.subst("$UPLOAD_SPEED") 
+    upload_speed = env.subst("$UPLOAD_SPEED") or DEFAULT_UPLOAD_SPEED
     firmware_path = str(source[0])
     
     # ESP32-P4 specific esptool command
@@ -23,7 +25,13 @@ def upload_using_esptool(source, target, env):
         "--chip", "esp32p4",
         "--port", upload_port,
         "--baud", upload_speed,
+    ]
+    # Some boards cannot run the flasher stub reliably at high baud rates
+    if os.environ.get("ESPTOOL_NO_STUB", "0") == "1":
+        cmd.append("--no-stub")
+    cmd += [
         "write_flash",
+        "--compress",
         "--flash_mode", "qio",
         "--flash_freq", "80m", 
         "--flash_size", "16MB",
@@ -33,15 +41,38 @@ def upload_using_esptool(source, target, env):
     print("Uploading firmware to ESP32-P4 M5Stack Tab5...")
     print("Command:", " ".join(cmd))
     
+    # Run esptool in-process when it is importable to skip interpreter startup
+    try:
+        import esptool
+    except ImportError:
+        esptool = None
+
+    if esptool is not None:
+        try:
+            esptool.main(cmd[1:])
+            rc = 0
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else int(bool(e.code))
+        except Exception as e:
+            print(f"Upload failed: {e}")
+            return 1
+        print("Upload successful!" if rc == 0 else f"Upload failed with error code {rc}")
+        return 0 if rc == 0 else 1
+
+    import subprocess
+    import sys
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        # Stream esptool output line by line so progress is visible while flashing
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, bufsize=1)
+        for line in proc.stdout:
+            sys.stdout.write(line)
+        rc = proc.wait()
+        if rc != 0:
+            print(f"Upload failed with error code {rc}")
+            return 1
         print("Upload successful!")
-        print(result.stdout)
         return 0
-    except subprocess.CalledProcessError as e:
-        print(f"Upload failed: {e}")
-        print(f"Error output: {e.stderr}")
-        return 1
     except FileNotFoundError:
         print("Error: esptool.py not found. Please install esptool.")
         return 1
@@ -49,4 +80,5 @@ def upload_using_esptool(source, target, env):
 # Override the default upload command for ESP32-P4
 if env.get("BOARD") == "m5tab5_p4" or "esp32p4" in env.get("BOARD_MCU", ""):
     env.Replace(UPLOADCMD=upload_using_esptool)
-    print("ESP32-P4 upload override enabled for Tab5duino-IDF framework")
\ No newline at end of file
+    if int(env.get("PIOVERBOSE", 0)):
+        print("ESP32-P4 upload override enabled for Tab5duino-IDF framework")
\ No newline at end of file
@@ -4,17 +4,91 @@ ESP32-P4 Upload Script for Native ESP-IDF Projects
 This script properly handles ESP32-P4 chip detection and flashing
 """
 
-import subprocess
-import sys
-import os
-from pathlib import Path
+def run_esptool(cmd):
+    """Run an esptool.py command line, in-process when esptool is importable"""
+    try:
+        import esptool
+    except ImportError:
+        import subprocess
+        return subprocess.run(cmd).returncode
+
+    try:
+        esptool.main(cmd[1:])
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else int(bool(e.code))
+
+def build_merged(build_dir, bootloader_bin, partitions_bin):
+    """Merge bootloader and partition table into one image flashed at 0x0"""
+    # The image ends with the partition table (0x8C00), so flashing it never
+    # touches nvs (0x9000) or phy_init (0xF000); the app is written separately
+    merged_bin = build_dir / 'bootloader.merged.bin'
+    inputs = [bootloader_bin, partitions_bin]
+    
+    # Only re-merge when one of the inputs is newer than the merged image
+    if merged_bin.exists() and merged_bin.stat().st_mtime >= max(f.stat().st_mtime for f in inputs):
+        return merged_bin
+    
+    returncode = run_esptool([
+        'esptool.py', '--chip', 'esp32p4', 'merge_bin',
+        '-o', str(merged_bin),
+        '--flash_mode', 'qio',
+        '--flash_freq', '80m',
+        '--flash_size', '16MB',
+        '0x0000', str(bootloader_bin),
+        '0x8000', str(partitions_bin)
+    ])
+    if returncode != 0:
+        raise RuntimeError(f"merge_bin failed with error code {returncode}")
+    return merged_bin
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file"""
+    import hashlib
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def load_last_flash(sha_file, upload_port):
+    """Return the region hashes last flashed to upload_port, or an empty dict"""
+    import json
+    try:
+        return json.loads(sha_file.read_text()).get(upload_port, {})
+    except (OSError, ValueError):
+        return {}
+
+def save_last_flash(sha_file, upload_port, hashes):
+    """Record the region hashes flashed to upload_port"""
+    import json
+    try:
+        record = json.loads(sha_file.read_text())
+    except (OSError, ValueError):
+        record = {}
+    record[upload_port] = hashes
+    sha_file.write_text(json.dumps(record, indent=2))
+
+def verify_regions(base_cmd, regions):
+    """Return True when the device flash already matches every (offset, file) region"""
+    args = []
+    for offset, path in regions:
+        args += [offset, str(path)]
+    try:
+        return run_esptool(base_cmd + [
+            'verify_flash',
+            '--flash_mode', 'qio',
+            '--flash_freq', '80m',
+            '--flash_size', '16MB',
+        ] + args) == 0
+    except Exception:
+        return False
 
 def main():
+    import os
+    from pathlib import Path
+    
     # Get environment variables
     project_dir = os.environ.get('PROJECT_DIR', '.')
     pioenv = os.environ.get('PIOENV', 'esp32p4_native')
     upload_port = os.environ.get('UPLOAD_PORT', '/dev/ttyACM1')
-    upload_speed = os.environ.get('UPLOAD_SPEED', '460800')
+    upload_speed = os.environ.get('UPLOAD_SPEED', '921600')
     
     # Build directory
     build_dir = Path(project_dir) / '.pio' / 'build' / pioenv
@@ -31,22 +105,65 @@ def main():
         print("Run 'pio run' to build the project first.")
         return 1
     
-    # ESP32-P4 flash command with proper addresses
-    cmd = [
+    force = os.environ.get('FORCE', '0') == '1'
+    reflash = os.environ.get('REFLASH', '0') == '1'
+    
+    base_cmd = [
         'esptool.py', '--chip', 'esp32p4',
         '--port', upload_port, '--baud', upload_speed,
+    ]
+    # Fall back to the ROM loader on boards where the stub fails at high baud
+    if os.environ.get('ESPTOOL_NO_STUB', '0') == '1':
+        base_cmd.append('--no-stub')
+    
+    # Skip regions whose contents match what was last flashed to this port
+    sha_file = build_dir / '.last_flash_sha'
+    regions = {
+        'bootloader': ('0x0000', bootloader_bin),
+        'partitions': ('0x8000', partitions_bin),
+        'firmware': ('0x10000', firmware_bin),
+    }
+    hashes = {name: file_sha256(path) for name, (_, path) in regions.items()}
+    last_hashes = {} if reflash else load_last_flash(sha_file, upload_port)
+    changed = [name for name, digest in hashes.items() if last_hashes.get(name) != digest]
+    
+    # The record is only a hint: before skipping the upload, confirm on-device that
+    # the board behind this port was not swapped or erased (no reset, the app keeps running)
+    if not changed:
+        if verify_regions(base_cmd + ['--after', 'no_reset'], list(regions.values())):
+            print("Firmware unchanged since last upload, nothing to flash (set REFLASH=1 to re-flash)")
+            return 0
+        print("Device flash does not match the last upload, re-flashing all regions")
+        changed = list(regions)
+    
+    # Bootloader (0x0000) and partition table (0x8000) in one image; it is small,
+    # so it is always rewritten rather than verified when anything changed
+    try:
+        merged_bin = build_merged(build_dir, bootloader_bin, partitions_bin)
+    except Exception as e:
+        print(f"Upload failed: {e}")
+        return 1
+    flash_args = ['0x0000', str(merged_bin)]
+    if 'firmware' in changed:
+        # Application at 0x10000
+        flash_args += ['0x10000', str(firmware_bin)]
+    
+    # ESP32-P4 flash command
+    cmd = list(base_cmd)
+    # Keep the flasher stub running so a follow-up flash can reuse it
+    if os.environ.get('KEEP_STUB', '0') == '1':
+        cmd += ['--after', 'no_reset_stub']
+    cmd += [
         'write_flash',
+        '--compress',
         '--flash_mode', 'qio',
         '--flash_freq', '80m', 
         '--flash_size', '16MB',
-        '--force',
-        # Bootloader at 0x0000
-        '0x0000', str(bootloader_bin),
-        # Partition table at 0x8000  
-        '0x8000', str(partitions_bin),
-        # Application at 0x10000
-        '0x10000', str(firmware_bin)
     ]
+    # --force bypasses esptool's safety checks, only use it when asked to
+    if force:
+        cmd.append('--force')
+    cmd += flash_args
     
     print("=" * 60)
     print("ESP32-P4 Native ESP-IDF Upload")
@@ -56,19 +173,22 @@ def main():
     print(f"Bootloader: {bootloader_bin}")
     print(f"Partitions: {partitions_bin}")
     print(f"Firmware: {firmware_bin}")
+    print(f"Regions: {', '.join(changed)}")
     print("=" * 60)
     
     # Execute upload
     try:
-        result = subprocess.run(cmd, check=True)
+        returncode = run_esptool(cmd)
+        if returncode != 0:
+            print(f"Upload failed with error code {returncode}")
+            return returncode
+        save_last_flash(sha_file, upload_port, hashes)
         print("Upload completed successfully!")
         return 0
-    except subprocess.CalledProcessError as e:
-        print(f"Upload failed with error code {e.returncode}")
-        return e.returncode
     except Exception as e:
         print(f"Upload failed: {e}")
         return 1
 
 if __name__ == '__main__':
+    import sys
     sys.exit(main())
\ No newline at end of file